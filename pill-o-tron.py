@@ -16,83 +16,213 @@ For a given mean, the lowest standard-deviation schedule, with the shortest peri
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+import contextlib
+from dataclasses import dataclass
 from fractions import Fraction
-from typing import NamedTuple
+from typing import Iterable, Iterator
+import functools
+import itertools
 import math
+import operator
+import os
+import sys
 
 
-def generate_partitions(num_stacks: int, total: int) -> list[tuple[int]]:
+def generate_partitions(num_stacks: int, total: int) -> Iterator[tuple[int, ...]]:
     """Generate integer partitions of 'total' into 'num_stacks'.
 
-    This returns a list of tuples.
+    This yields tuples, one at a time.
     Each tuple contains "num_stacks" elements.
     Each tuple element is a non-negative integer.
     The sum of each tuple is "total".
+
+    The partitions are enumerated iteratively, starting with all of 'total' in the first stack. Each next partition
+    is found by moving a single unit out of the rightmost non-empty stack (ignoring the last stack) into the stack
+    after it, and merging the contents of the last stack into that stack as well.
     """
 
     if num_stacks == 0:
         if total == 0:
-            return [()]
-        else:
-            return []
+            yield ()
+        return
+
+    stacks = [0] * num_stacks
+    stacks[0] = total
+
+    yield tuple(stacks)
+
+    while True:
+        # Find the rightmost non-empty stack, not counting the last stack.
+        index = num_stacks - 2
+        while index >= 0 and stacks[index] == 0:
+            index -= 1
+
+        if index < 0:
+            # All units are in the last stack; this was the final partition.
+            break
+
+        stacks[index] -= 1
+        stacks[index + 1] = stacks[-1] + 1
+        if index + 1 != num_stacks - 1:
+            stacks[-1] = 0
+
+        yield tuple(stacks)
+
+
+def pack_counts(counts: Iterable[int], count_bits: int) -> int:
+    """Pack counts into a single integer, using 'count_bits' bits per count.
+
+    The first count ends up in the least significant bits.
+    """
+    packed_counts = 0
+    for (index, count) in enumerate(counts):
+        packed_counts |= count << (index * count_bits)
+    return packed_counts
+
+
+def unpack_counts(packed_counts: int, num_counts: int, count_bits: int) -> tuple[int, ...]:
+    """Unpack 'num_counts' counts of 'count_bits' bits each from a single integer; see pack_counts."""
+    mask = (1 << count_bits) - 1
+    return tuple((packed_counts >> (index * count_bits)) & mask for index in range(num_counts))
 
-    solutions = []
 
-    for last_stack in range(0, total + 1):
-        stacks_before_solutions = generate_partitions(num_stacks - 1, total - last_stack)
-        solutions.extend(stacks_before_solution + (last_stack, ) for stacks_before_solution in stacks_before_solutions)
+@functools.lru_cache(maxsize=None)
+def calculate_partition_moments(quarter_dosages: tuple[int, ...], total: int, count_bits: int) -> tuple[tuple[int, int, int, int], ...]:
+    """Calculate the moments of all partitions of 'total' over the given dosages.
+
+    The dosages are given as integer numbers of quarter pills.
+
+    This returns a tuple that contains, for each partition, a tuple (packed_counts, moment1, moment2, divisor), where
+    packed_counts holds the counts packed into a single integer with 'count_bits' bits per dosage (see pack_counts),
+    moment1 and moment2 are the sums of the dosages and squared dosages over all days, and divisor is the greatest
+    common divisor of the counts.
+
+    The results are memoized: the partitions of a period are built from the partitions of all smaller totals over
+    all but the last dosage, and these are shared between periods. Note that the cache is per process; with multiple
+    worker processes, each worker rebuilds the entries for the periods it handles, so the sharing is only complete
+    when running with a single job.
+    """
+    quarter_dosages_squared = [quarter_dosage * quarter_dosage for quarter_dosage in quarter_dosages]
+
+    return tuple(
+        (
+            pack_counts(counts, count_bits),
+            sum(map(operator.mul, quarter_dosages, counts)),
+            sum(map(operator.mul, quarter_dosages_squared, counts)),
+            math.gcd(*counts)
+        )
+        for counts in generate_partitions(len(quarter_dosages), total)
+    )
+
+
+def find_best_schedules_for_period(quarter_dosages: tuple[int, ...], common_period: int, count_bits: int, period: int) -> dict[int, tuple[float, list[int]]]:
+    """Find the dosage schedules with the lowest standard deviation for each mean reachable in the given period.
+
+    The dosages are given as integer numbers of quarter pills. All partitions of the period are enumerated, scored,
+    and selected in a single loop.
+
+    Each partition is composed of the count for the last dosage and a partition of the remaining days over the other
+    dosages. The moments of the latter are memoized (see calculate_partition_moments), so the moments of each
+    partition follow from a few integer operations.
+
+    The mean is represented as a single integer, in units of 1 / (4 * common_period) pills/day, where common_period
+    must be a multiple of the period. If the same common_period is used for all periods, these integers are exact,
+    cheap to hash, and order the means of all schedules correctly.
+
+    If the counts of a schedule share a common divisor g > 1, the schedule is a g-fold repetition of a schedule
+    with period (period / g) that has the same mean and standard deviation. Such schedules are skipped, since the
+    shorter schedule is preferred.
+
+    This returns a dictionary that maps each mean to a tuple of the lowest standard deviation found, in pills/day,
+    and a list of the partitions that attain it (normally just one). The partitions are represented as counts packed
+    with 'count_bits' bits per dosage; see pack_counts. The number of bits must suffice to hold the period.
+    """
+    other_quarter_dosages = quarter_dosages[:-1]
+    last_quarter_dosage = quarter_dosages[-1]
+    last_shift = count_bits * len(other_quarter_dosages)
+
+    mean_multiplier = common_period // period
+    variance_denominator = 16 * period * period
 
-    return solutions
+    best_schedules = {}
+
+    for last_count in range(0, period + 1):
+
+        last_moment1 = last_quarter_dosage * last_count
+        last_moment2 = last_quarter_dosage * last_moment1
+        last_packed_count = last_count << last_shift
+
+        for (other_packed_counts, other_moment1, other_moment2, other_divisor) in calculate_partition_moments(other_quarter_dosages, period - last_count, count_bits):
+
+            if math.gcd(other_divisor, last_count) != 1:
+                continue
+
+            moment1 = other_moment1 + last_moment1
+            moment2 = other_moment2 + last_moment2
+
+            mean = moment1 * mean_multiplier
+
+            # Within a period, the variance denominator is constant, so schedules are compared by the exact integer
+            # variance numerator. The standard deviation is only calculated for the schedules that are kept.
+            variance_numerator = period * moment2 - moment1 * moment1
+
+            best = best_schedules.get(mean)
+            if best is None or variance_numerator < best[0]:
+                best_schedules[mean] = (variance_numerator, [other_packed_counts | last_packed_count])
+            elif variance_numerator == best[0]:
+                best[1].append(other_packed_counts | last_packed_count)
+
+    # Integer true division is correctly rounded, so schedules with equal variance (also across different periods)
+    # are guaranteed to get identical standard deviations.
+    return {
+        mean: (math.sqrt(variance_numerator / variance_denominator), partitions)
+        for (mean, (variance_numerator, partitions)) in best_schedules.items()
+    }
+
+
+# Dosages that are represented by a single character. All other dosages are printed inside parentheses.
+DOSAGE_STRINGS = {Fraction(n): str(n) for n in range(10)} | {
+    Fraction(1, 2): "h",  # Dutch: "half".
+    Fraction(1, 4): "k",  # Dutch: "kwart".
+    Fraction(3, 2): "a"   # Dutch: "anderhalf".
+}
 
 
 def fraction_to_dosage_string(dosage: Fraction) -> str:
     """Represent a fraction as a dosage string."""
-    if dosage.denominator == 1 and 0 <= dosage.numerator <= 9:
-        # Represent single-digit integer doses by just the integer.
-        return str(dosage.numerator)
-    elif dosage == Fraction(1, 2):
-        # Dutch: "half".
-        return "h"
-    elif dosage == Fraction(1, 4):
-        # Dutch: "kwart".
-        return "k"
-    elif dosage == Fraction(3, 2):
-        # Dutch: "anderhalf"
-        return "a"
-    else:
-        # All other dosages are printed inside parentheses.
-        return "({})".format(dosage)
+    return DOSAGE_STRINGS.get(dosage) or "({})".format(dosage)
 
 
-def possible_dosages_to_string(possible_dosages: list[Fraction]) -> str:
-    return ",".join(str(float(dosage)) for dosage in possible_dosages)
+@functools.lru_cache(maxsize=None)
+def repeated_dosage_string(dosage: Fraction, count: int) -> str:
+    """Represent a dosage that is taken for 'count' days as a dosage string."""
+    return count * fraction_to_dosage_string(dosage)
 
-class DosageSchedule(NamedTuple):
-    """A dosage schedule."""
 
-    possible_dosages: list[Fraction]
-    counts: tuple[int]
+def possible_dosages_to_string(possible_dosages: list[Fraction]) -> str:
+    return ",".join(str(float(dosage)) for dosage in possible_dosages)
 
-    def period(self) -> int:
-        """Return the period, in days."""
-        return sum(self.counts)
+@dataclass(slots=True, frozen=True)
+class DosageSchedule:
+    """A dosage schedule.
 
-    def mean(self) -> float:
-        """Return the mean daily dose, in doses/day."""
-        return float(sum(dosage * count for (dosage, count) in zip(self.possible_dosages, self.counts)) / self.period())
+    The counts give the number of days that each of the possible dosages is taken; the possible dosages themselves
+    are shared by all schedules, and are not stored with each schedule. The mean daily dose and the standard
+    deviation of the daily dose are in doses/day.
+    """
 
-    def stddev(self) -> float:
-        """Return the standard deviation of the daily dose, in doses/day."""
-        mean = self.mean()
-        variance = sum((dosage - mean) ** 2 * count for (dosage, count) in zip(self.possible_dosages, self.counts)) / self.period()
-        return math.sqrt(variance)
+    counts: tuple[int, ...]
+    period: int
+    mean: float
+    stddev: float
 
-    def schedule_as_string(self) -> str:
+    def schedule_as_string(self, possible_dosages: list[Fraction]) -> str:
         """Return the dosage schedule as a string."""
         specs = []
-        for (dosage, count) in zip(self.possible_dosages, self.counts):
+        for (dosage, count) in zip(possible_dosages, self.counts):
             if count != 0:
-                spec = count * fraction_to_dosage_string(dosage)
+                spec = repeated_dosage_string(dosage, count)
                 specs.append(spec)
         return "".join(specs)
 
@@ -100,9 +230,9 @@ class DosageSchedule(NamedTuple):
 def show_optimal_schedules_plot(possible_dosages: list[Fraction], max_period: int, optimal_schedules: list[DosageSchedule]) -> None:
     """Show a plot of all optimal schedules."""
     import matplotlib.pyplot as plt
-    mean = [schedule.mean() for schedule in optimal_schedules]
-    stddev = [schedule.stddev() for schedule in optimal_schedules]
-    period = [schedule.period() for schedule in optimal_schedules]
+    mean = [schedule.mean for schedule in optimal_schedules]
+    stddev = [schedule.stddev for schedule in optimal_schedules]
+    period = [schedule.period for schedule in optimal_schedules]
 
     plt.scatter(mean, stddev, c=period)
     plt.title("\n{} schedules with different mean doses\npossible daily doses: {{{}}}; max period: {}\n(colors correspond to schedule period in days)\n".format(len(optimal_schedules), possible_dosages_to_string(possible_dosages), max_period))
@@ -130,14 +260,31 @@ def main():
         help="possible daily dosages, in pills, separated by comma (default: {})".format(default_possible_daily_dosages))
     parser.add_argument("--max-period","-p",  type=int, default=default_max_period,
         help="max period, in days (default: {})".format(default_max_period))
+    parser.add_argument("--jobs", "-j", type=int, default=None,
+        help="number of worker processes (default: number of CPUs)")
     parser.add_argument("--show-plot", "-s", action="store_true", help="show optimal schedules plot")
 
     args = parser.parse_args()
 
+    if args.jobs is not None and args.jobs < 1:
+        parser.error("argument --jobs/-j: must be at least 1")
+
+    jobs = args.jobs if args.jobs is not None else (os.cpu_count() or 1)
+
+    # On Windows, ProcessPoolExecutor does not accept more than 61 workers.
+    if sys.platform == "win32":
+        jobs = min(jobs, 61)
+
+    # There is one task per period; more workers than periods would only be started to sit idle.
+    jobs = max(1, min(jobs, args.max_period))
+
     possible_dosages_as_floats = [float(dosage) for dosage in args.possible_daily_dosages.split(",")]
 
     possible_dosages = sorted(set(Fraction(round(dosage * 4), 4) for dosage in possible_dosages_as_floats))
 
+    # For calculations, the dosages are represented as integer numbers of quarter pills.
+    quarter_dosages = tuple(int(dosage * 4) for dosage in possible_dosages)
+
     print("# Pill-O-Tron 1.0.3 - Copyright (c) 2023 by Sidney Cadot.")
     print("#")
     print("# Parameters:")
@@ -146,57 +293,68 @@ def main():
     print("#   --max-period: {}".format(args.max_period))
     print("#")
 
-    # Enumerate all dosage schedules.
+    # Enumerate all dosage schedules, and find the optimal schedule for each reachable mean.
+    #
+    # The schedules are processed one period at a time; for each period and mean, only the schedules with the
+    # lowest standard deviation are retained.
 
-    print("# Enumerating all dosage schedules ...")
+    print("# Enumerating all dosage schedules and rejecting non-optimal ones ...")
 
-    schedules = []
-    for period in range(1, args.max_period + 1):
-        partitions = generate_partitions(len(possible_dosages), period)
-        schedules.extend(DosageSchedule(possible_dosages, partition) for partition in partitions)
+    # The number of partitions of 'period' into N stacks is C(period + N - 1, N - 1); summed over all periods
+    # from 1 to max_period, this gives C(max_period + N, N) - 1.
+    num_schedules = math.comb(max(args.max_period, 0) + len(possible_dosages), len(possible_dosages)) - 1
 
-    print("# Possible dosage schedules found: {}.".format(len(schedules)))
+    # All means are expressed as integer multiples of 1 / (4 * common_period) pills/day.
+    common_period = math.lcm(*range(1, args.max_period + 1))
 
-    # Order schedules by mean.
+    # Schedules are represented by their counts packed into a single integer, with enough bits per count to hold
+    # the longest period.
+    count_bits = args.max_period.bit_length()
 
-    print("# Finding reachable mean daily dosages ...")
+    # The periods are independent, so they can be handled by separate worker processes. The work per period grows
+    # with the period, so the longest periods are submitted first to keep the workers evenly loaded.
+
+    periods = range(args.max_period, 0, -1)
+
+    # The results for each period are merged as soon as they arrive, keeping only the best (stddev, period, partitions)
+    # found so far for each mean.
 
     schedules_by_mean = {}
 
-    for schedule in schedules:
-        mean = schedule.mean()
+    with contextlib.ExitStack() as stack:
 
-        if mean in schedules_by_mean:
-            schedules_by_mean[mean].append(schedule)
+        if jobs == 1:
+            map_function = map
         else:
-            schedules_by_mean[mean] = [schedule]
-
-    print("# Reachable mean daily dosages found: {}.".format(len(schedules_by_mean)))
+            map_function = stack.enter_context(ProcessPoolExecutor(max_workers=jobs)).map
 
-    means_reachable = sorted(schedules_by_mean)
+        best_schedules_per_period = map_function(find_best_schedules_for_period, itertools.repeat(quarter_dosages), itertools.repeat(common_period), itertools.repeat(count_bits), periods)
 
-    # Find optimal schedules for each mean, by rejecting non-optimal ones.
+        for (period, best_schedules) in zip(periods, best_schedules_per_period):
+            for (mean, (stddev, partitions)) in best_schedules.items():
+                best = schedules_by_mean.get(mean)
+                # Lower standard deviation is more important than lower period, so we compare standard deviations first.
+                if best is None or (stddev, period) < best[:2]:
+                    schedules_by_mean[mean] = (stddev, period, partitions)
 
-    print("# Rejecting non-optimal dosage schedules ...")
+    # Only the (relatively few) reachable means need to be sorted.
 
     optimal_schedules = []
-    for mean in means_reachable:
-        schedules = schedules_by_mean[mean]
-
-        # Lower standard deviation is more important than lower period, so we select for lowest standard deviation first.
-        min_stddev = min(schedule.stddev() for schedule in schedules)
-        schedules = [schedule for schedule in schedules if schedule.stddev() == min_stddev]
-
-        # For schedules with the same mean and stddev, reject ones that are longer than necessary.
-        min_period = min(schedule.period() for schedule in schedules)
-        schedules = [schedule for schedule in schedules if schedule.period() == min_period]
+    for mean in sorted(schedules_by_mean):
+        (stddev, period, partitions) = schedules_by_mean[mean]
+        schedules = [
+            DosageSchedule(unpack_counts(packed_counts, len(possible_dosages), count_bits), period, mean / (4 * common_period), stddev)
+            for packed_counts in partitions
+        ]
 
         if len(schedules) != 1:
             print(schedules)
             raise RuntimeError("Found multiple dosage schedules with the same stdandard deviation and period.")
 
-        schedule = schedules[0]
-        optimal_schedules.append(schedule)
+        optimal_schedules.append(schedules[0])
+
+    print("# Possible dosage schedules found: {}.".format(num_schedules))
+    print("# Reachable mean daily dosages found: {}.".format(len(optimal_schedules)))
 
     print("# Done. Report for {} optimal dosage schedules follows:".format(len(optimal_schedules)))
     print()
@@ -206,10 +364,10 @@ def main():
     for schedule in optimal_schedules:
 
         print("mean {:10.6f}    stddev {:10.6f}    period {:6d}    schedule  {}".format(
-            schedule.mean(),
-            schedule.stddev(),
-            schedule.period(),
-            schedule.schedule_as_string()
+            schedule.mean,
+            schedule.stddev,
+            schedule.period,
+            schedule.schedule_as_string(possible_dosages)
         ))
 
     if args.show_plot: